@@ -24,18 +24,24 @@
 
 # Import from standard library. https://docs.python.org/3/library/
 
-from urllib.parse import urlparse
+import bisect
+import collections
+from contextlib import contextmanager
+from urllib.parse import quote, unquote, urlsplit
+import concurrent.futures
+import functools
 import json
 import logging
 import os
 import re
-import string
 import threading
 import time
+import weakref
 
 # Import from https://pypi.org/
 
 import psycopg2
+import psycopg2.pool
 
 # Metadata
 
@@ -48,122 +54,107 @@ __updated__ = '2022-05-19'
 SENZING_PRODUCT_ID = "5017"
 log_format = '%(asctime)s %(message)s'
 
-# Lists from https://www.ietf.org/rfc/rfc1738.txt
-
-safe_character_list = ['$', '-', '_', '.', '+', '!',
-                       '*', '(', ')', ',', '"'] + list(string.ascii_letters)
-unsafe_character_list = ['"', '<', '>', '#', '%',
-                         '{', '}', '|', '\\', '^', '~', '[', ']', '`']
-reserved_character_list = [';', ',', '/', '?', ':', '@', '=', '&']
-
-
-class Governor:
-
-    # -------------------------------------------------------------------------
-    # Internal methods for database URL parsing.
-    # -------------------------------------------------------------------------
-
-    def translate(self, map, astring):
-        new_string = str(astring)
-        for key, value in map.items():
-            new_string = new_string.replace(key, value)
-        return new_string
-
-    def get_unsafe_characters(self, astring):
-        result = []
-        for unsafe_character in unsafe_character_list:
-            if unsafe_character in astring:
-                result.append(unsafe_character)
-        return result
-
-    def get_safe_characters(self, astring):
-        result = []
-        for safe_character in safe_character_list:
-            if safe_character not in astring:
-                result.append(safe_character)
-        return result
-
-    def parse_database_url(self, original_senzing_database_url):
-        ''' Given a canonical database URL, decompose into URL components. '''
-
-        result = {}
+@functools.lru_cache(maxsize=32)
+def _compile_format(format_string):
+    """
+    Compile a format string like "{scheme}://{username}..." into a regular
+    expression with a named group per keyword.  Cached so repeated parses of
+    the same template skip the split/escape/join work.
+    See https://stackoverflow.com/questions/10663093/use-python-format-string-in-reverse-for-parsing
+    """
+
+    # First split on any keyword arguments, note that the names of keyword arguments will be in the
+    # 1st, 3rd, ... positions in this list
+
+    tokens = re.split(r'\{(.*?)\}', format_string)
+    keywords = tokens[1::2]
+
+    # Now replace keyword arguments with named groups matching them. We also escape between keyword
+    # arguments so we support meta-characters there. Re-join tokens to form our regexp pattern
+
+    tokens[1::2] = map(u'(?P<{}>.*)'.format, keywords)
+    tokens[0::2] = map(re.escape, tokens[0::2])
+    return re.compile(''.join(tokens))
+
+
+@functools.lru_cache(maxsize=16)
+def parse_database_url(original_senzing_database_url):
+    ''' Given a canonical database URL, decompose into URL components.
+        Memoized so repeated URLs (restarts, duplicated env vars) parse once. '''
+
+    # Split off the userinfo and path by hand, percent-encode them so
+    # characters like '%', '@' and '^' in passwords can't confuse urlsplit,
+    # then decode each component on the way back out.
+
+    scheme, _, rest = original_senzing_database_url.partition('://')
+    netloc, _, path = rest.partition('/')
+    userinfo, _, hostport = netloc.rpartition('@')
+    username, _, password = userinfo.partition(':')
+
+    # Only the database name itself belongs in dbname: the conventional
+    # Senzing CONNECTION string yields a trailing slash ("...:5432/G2/")
+    # and the URL may carry a query or fragment, both of which must be
+    # dropped before quoting or they would be encoded into the name.
+
+    path = path.partition('?')[0].partition('#')[0].strip('/')
+
+    parsed = urlsplit('{0}://{1}:{2}@{3}/{4}'.format(
+        scheme,
+        quote(username, safe=''),
+        quote(password, safe=''),
+        hostport,
+        quote(path, safe='')))
+
+    # Construct result.
+
+    result = {
+        'dbname': unquote(parsed.path.strip('/')),
+        'host': parsed.hostname,
+        'password': unquote(parsed.password or ''),
+        'port': str(parsed.port),
+        'user': unquote(parsed.username or ''),
+    }
 
-        # Get the value of SENZING_DATABASE_URL environment variable.
+    # Return result.
 
-        senzing_database_url = original_senzing_database_url
+    return result
 
-        # Create lists of safe and unsafe characters.
 
-        unsafe_characters = self.get_unsafe_characters(senzing_database_url)
-        safe_characters = self.get_safe_characters(senzing_database_url)
+@functools.lru_cache(maxsize=64)
+def parse_string(format_string, string_to_be_parsed):
+    """
+    Match string_to_be_parsed against the given format string, return dictionary of matches.
+    Memoized; the compiled pattern comes from the _compile_format() cache.
+    """
 
-        # Detect an error condition where there are not enough safe characters.
+    matches = _compile_format(format_string).match(string_to_be_parsed)
+    if not matches:
+        raise Exception("Format string did not match")
 
-        if len(unsafe_characters) > len(safe_characters):
-            logging.error("There are not enough safe characters to do the translation. Unsafe Characters: {0}; Safe Characters: {1}".format(
-                unsafe_characters, safe_characters))
-            return result
+    # Return a dict with all of our keywords and their values
 
-        # Perform translation.
-        # This makes a map of safe character mapping to unsafe characters.
-        # "senzing_database_url" is modified to have only safe characters.
+    return matches.groupdict()
 
-        translation_map = {}
-        safe_characters_index = 0
-        for unsafe_character in unsafe_characters:
-            safe_character = safe_characters[safe_characters_index]
-            safe_characters_index += 1
-            translation_map[safe_character] = unsafe_character
-            senzing_database_url = senzing_database_url.replace(
-                unsafe_character, safe_character)
 
-        # Parse "translated" URL.
+# One entry per monitored database.  Attribute access on a namedtuple is a
+# C-level slot read, cheaper than the dict.get() chains it replaces.
 
-        parsed = urlparse(senzing_database_url)
-        schema = parsed.path.strip('/')
+DBConn = collections.namedtuple("DBConn", "pool host dbname")
 
-        # Construct result.
 
-        result = {
-            'dbname': self.translate(translation_map, schema),
-            'host': self.translate(translation_map, parsed.hostname),
-            'password': self.translate(translation_map, parsed.password),
-            'port': self.translate(translation_map, parsed.port),
-            'user': self.translate(translation_map, parsed.username),
-        }
+class Governor:
 
-        # Return result.
+    # -------------------------------------------------------------------------
+    # Internal methods for database URL parsing.
+    # -------------------------------------------------------------------------
 
-        return result
+    def parse_database_url(self, original_senzing_database_url):
+        ''' Thin wrapper over the memoized module-level parse_database_url(). '''
+        return parse_database_url(original_senzing_database_url)
 
     def parse_string(self, format_string, string_to_be_parsed):
-        """
-        Match string_to_be_parsed against the given format string, return dictionary of matches.
-        See https://stackoverflow.com/questions/10663093/use-python-format-string-in-reverse-for-parsing
-        """
-
-        # First split on any keyword arguments, note that the names of keyword arguments will be in the
-        # 1st, 3rd, ... positions in this list
-
-        tokens = re.split(r'\{(.*?)\}', format_string)
-        keywords = tokens[1::2]
-
-        # Now replace keyword arguments with named groups matching them. We also escape between keyword
-        # arguments so we support meta-characters there. Re-join tokens to form our regexp pattern
-
-        tokens[1::2] = map(u'(?P<{}>.*)'.format, keywords)
-        tokens[0::2] = map(re.escape, tokens[0::2])
-        pattern = ''.join(tokens)
-
-        # Use our pattern to match the given string, raise if it doesn't match
-
-        matches = re.match(pattern, string_to_be_parsed)
-        if not matches:
-            raise Exception("Format string did not match")
-
-        # Return a dict with all of our keywords and their values
-
-        return {x: matches.group(x) for x in keywords}
+        ''' Thin wrapper over the memoized module-level parse_string(). '''
+        return parse_string(format_string, string_to_be_parsed)
 
     # -------------------------------------------------------------------------
     # Internal methods for extracting
@@ -202,10 +193,52 @@ class Governor:
 
     def get_current_watermark(self, cursor):
 
-        cursor.execute(self.sql_stmt)
+        cursor.execute(self.exec_sql_stmt)
         result = cursor.fetchone()
         return result[0], result[1]
 
+    @contextmanager
+    def open_cursor(self, database_connection):
+        ''' Check a connection out of the pool and yield a cursor on it. '''
+
+        pool = database_connection.pool
+        connection = pool.getconn()
+        try:
+
+            # Pooled connections are created lazily, so configure the session
+            # and PREPARE the watermark statement the first time each one is
+            # checked out.  The tracking set holds weak references to the
+            # connection objects themselves: the pool silently replaces
+            # broken connections, and a replacement can reuse the freed
+            # object's id(), so an id()-keyed set could wrongly skip this
+            # setup and leave the statement unprepared forever.
+
+            if connection not in self.prepared_connections:
+                connection.set_session(
+                    autocommit=True, isolation_level='READ UNCOMMITTED', readonly=True)
+                with connection.cursor() as cursor:
+                    cursor.execute(self.prepare_sql_stmt)
+                self.prepared_connections.add(connection)
+
+            with connection.cursor() as cursor:
+                yield cursor
+        finally:
+            pool.putconn(connection)
+
+    def check_database(self, database_connection):
+        ''' Fetch the current watermark for one monitored database. '''
+
+        with self.open_cursor(database_connection) as cursor:
+            return self.get_current_watermark(cursor)
+
+    def get_relation_size(self, database_connection, oid_name):
+        ''' Fetch the human-readable size of one relation.  Expensive; only
+            called when a log message is emitted. '''
+
+        with self.open_cursor(database_connection) as cursor:
+            cursor.execute(self.size_sql_stmt, (oid_name,))
+            return cursor.fetchone()[0]
+
     # -------------------------------------------------------------------------
     # Support for Python Context Manager.
     # -------------------------------------------------------------------------
@@ -242,9 +275,6 @@ class Governor:
         # Instance variables. Precedence: 1) OS Environment variables, 2) parameters
 
         self.old_wait_time = 0.0
-        self.counter = 0
-        self.counter_lock = threading.Lock()
-        self.last_log_time = 0
         # update this data structure to change the back-off step times.
         #  1.0 means that we're at the highwater mark so we should pause longer
         #  to allow the database to catch up.  More steps could be added or times
@@ -264,6 +294,13 @@ class Governor:
             (0.0, 0.0),
         ]
 
+        # bisect-friendly reshaping of step_ratios: keys ascend as
+        # (1 - ratio) and the wait times keep their original order, with a
+        # trailing 0.0 for ratios at or below the lowest step.
+
+        self.step_ratio_keys = [1.0 - ratio for ratio, _ in self.step_ratios]
+        self.step_wait_times = [wait for _, wait in self.step_ratios] + [0.0]
+
         # Database connection string. Precedence: 1) SENZING_GOVERNOR_DATABASE_URLS, 2) SENZING_DATABASE_URL, 3) SENZING_ENGINE_CONFIGURATION_JSON 4) parameters
 
         self.database_urls = database_urls
@@ -282,7 +319,17 @@ class Governor:
             "SENZING_GOVERNOR_LIST_SEPARATOR", list_separator)
         self.low_watermark = int(
             os.getenv("SENZING_GOVERNOR_POSTGRESQL_LOW_WATERMARK", low_watermark))
-        self.sql_stmt = "SELECT c.oid::regclass, age(c.relfrozenxid), pg_size_pretty(pg_total_relation_size(c.oid)) FROM pg_class c JOIN pg_namespace n on c.relnamespace = n.oid WHERE relkind IN ('r', 't', 'm') AND n.nspname NOT IN ('pg_toast') ORDER BY 2 DESC LIMIT 1;"
+        # The hot query only fetches the relation and XID age.
+        # pg_total_relation_size walks the relation plus toast and indexes on
+        # every call, so the size lookup lives in a separate statement that is
+        # only run when a log message is actually emitted.
+        self.sql_stmt = "SELECT c.oid::regclass::text, age(c.relfrozenxid) FROM pg_class c JOIN pg_namespace n on c.relnamespace = n.oid WHERE relkind IN ('r', 't', 'm') AND n.nspname NOT IN ('pg_toast') ORDER BY 2 DESC LIMIT 1;"
+        self.size_sql_stmt = "SELECT pg_size_pretty(pg_total_relation_size(%s::regclass))"
+        # The statement is PREPAREd once per connection so Postgres only
+        # parses and plans it once; every check afterward is an EXECUTE.
+        self.prepare_sql_stmt = "PREPARE gov_xid_check AS " + \
+            self.sql_stmt.rstrip(';')
+        self.exec_sql_stmt = "EXECUTE gov_xid_check"
         self.check_time_interval_in_seconds = int(os.getenv(
             "SENZING_GOVERNOR_CHECK_TIME_INTERVAL_IN_SECONDS", check_time_interval_in_seconds))
         self.log_interval_in_seconds = int(
@@ -291,12 +338,21 @@ class Governor:
             SENZING_PRODUCT_ID, self.high_watermark, self.interval, self.low_watermark, self.hint, self.log_interval_in_seconds))
 
         # Synthesize variables.
+        # wait_time_cache is the last wait time published by the background
+        # checker, read lock-free by every thread on the govern() fast path.
+        # Float attribute assignment is atomic in CPython.
+
+        self.wait_time_cache = 0.0
+
+        # last_log_time is kept in the monotonic frame; start it far enough
+        # in the past that the first check always logs.
 
-        self.next_check_time = time.time() + self.check_time_interval_in_seconds
+        self.last_log_time = time.monotonic() - self.log_interval_in_seconds - 1
 
-        # Make database connections.
+        # Make database connection pools.
 
         self.database_connections = {}
+        self.prepared_connections = weakref.WeakSet()
         if self.database_urls:
             sql_connection_strings = self.database_urls.split(
                 self.list_separator)
@@ -313,20 +369,39 @@ class Governor:
                         product_id=SENZING_PRODUCT_ID, schema=schema, **parsed_database_url))
                     continue
 
-                # Create connection.
+                # Create connection pool.  Connections are checked out per
+                # check and reused, avoiding TCP+TLS+auth setup on reconnect.
 
                 logging.info("senzing-{product_id}0003I Governor monitoring {schema}://{user}:xxxxxxxx@{host}:{port}/{dbname}".format(
                     product_id=SENZING_PRODUCT_ID, schema=schema, **parsed_database_url))
-                connection = psycopg2.connect(**parsed_database_url)
-                connection.set_session(
-                    autocommit=True, isolation_level='READ UNCOMMITTED', readonly=True)
-                cursor = connection.cursor()
-
-                self.database_connections[database_connection_string] = {
-                    'parsed_database_url': parsed_database_url,
-                    'connection': connection,
-                    'cursor': cursor,
-                }
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    1, 4, **parsed_database_url)
+
+                self.database_connections[database_connection_string] = DBConn(
+                    pool=pool,
+                    host=parsed_database_url['host'],
+                    dbname=parsed_database_url['dbname'],
+                )
+
+        # Thread pool used to fan the watermark queries out to all monitored
+        # databases at once, so check time is the slowest round-trip rather
+        # than the sum of them.
+
+        self.check_pool = None
+        if self.database_connections:
+            self.check_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.database_connections))
+
+        # Background checker.  Worker threads never run the SQL themselves;
+        # this daemon thread refreshes the published wait time every
+        # check_time_interval_in_seconds and govern() just reads it.
+
+        self.stop_event = threading.Event()
+        self.checker_thread = None
+        if self.database_connections:
+            self.checker_thread = threading.Thread(
+                target=self.check_loop, name="governor-check", daemon=True)
+            self.checker_thread.start()
 
     def get_wait_time(self, watermark):
         """
@@ -344,72 +419,132 @@ class Governor:
         # watermark_percentage = watermark_ratio * 100
         # wait_time = ((1.1**watermark_percentage)-1)/100
 
-        for step in self.step_ratios:
-            if watermark_ratio > step[0]:
-                return step[1]
+        # Equivalent to scanning step_ratios for the first step whose ratio
+        # is below watermark_ratio, but as one C-level binary search.
 
-        return 0.0
+        return self.step_wait_times[bisect.bisect_right(
+            self.step_ratio_keys, 1.0 - watermark_ratio)]
 
-    def govern(self, *args, **kwargs):
+    def fast_check(self, *args, **kwargs):
         """
-        Do the actual "governing".
-        Do not return until the governance has been completed.
-        The caller of govern() waits synchronously.
+        Kept for callers on the hot path; the same lock-free read as
+        govern() now that the checks run on the background thread.
         """
 
-        # counter_lock serializes threads.
-
-        with self.counter_lock:
-            self.counter += 1
+        return self.wait_time_cache
 
-            # Only make expensive checks after "interval" records have been read.
+    def govern(self, *args, **kwargs):
+        """
+        Do the actual "governing".
+        The expensive checks run on the background checker thread; this is
+        a single lock-free attribute read of the last published wait time,
+        so it is safe to call at any rate from any worker thread.
+        """
 
-            if (self.counter % self.interval == 0) or (time.time() > self.next_check_time):
+        return self.wait_time_cache
 
-                # Reset timer.
+    def check_loop(self):
+        """
+        Body of the background checker thread.  Refreshes the published
+        wait time every check_time_interval_in_seconds until close().  A
+        failed check keeps the previous wait time and is retried on the
+        next cycle rather than killing the thread.
+        """
 
-                self.next_check_time = time.time() + self.check_time_interval_in_seconds
+        while not self.stop_event.is_set():
+            try:
+                self.perform_check()
+            except Exception as err:
+                logging.warning("senzing-{0}0702W Governor check failed, will retry: {1}".format(
+                    SENZING_PRODUCT_ID, err))
+            self.stop_event.wait(self.check_time_interval_in_seconds)
 
-                # Go through each database connection to determine if watermark is above high_watermark.
+    def perform_check(self, *args, **kwargs):
+        """
+        The slow path: query every monitored database, derive the wait time
+        from the worst XID, and refresh the memoized result.  Runs with no
+        locks held; old_wait_time and wait_time_cache are plain attributes
+        whose assignment is atomic in CPython.
+        """
 
-                for database_connection in self.database_connections.values():
-                    cursor = database_connection.get("cursor")
-                    database_host = database_connection.get(
-                        "parsed_database_url", {}).get("host")
-                    database_name = database_connection.get(
-                        "parsed_database_url", {}).get("dbname")
-                    oid_name, watermark = self.get_current_watermark(cursor)
+        # One timestamp covers the whole check; the log-interval comparisons
+        # don't need sub-check precision.
 
-                    current_log_time = time.time()
-                    # only log a message when the log interval has passed
-                    if ((current_log_time - self.last_log_time) > self.log_interval_in_seconds):
-                        logging.info("senzing-{0}0004I Governor is checking PostgreSQL Transaction IDs. Host: {1}; Database: {2}; Current XID: {3} ({4}); High watermark XID: {5}".format(
-                            SENZING_PRODUCT_ID, database_host, database_name, watermark, oid_name, self.high_watermark))
-                        self.last_log_time = current_log_time
+        now = time.monotonic()
 
-                    # When we get above the low water mark, use our wait time
-                    # function to start to slow down.
+        # Query every monitored database concurrently; the worst (highest)
+        # XID across all of them drives the wait time.
 
-                    if watermark > self.low_watermark: # This all needs to be done based on the worst XID if all DBs
-                        wait_time = self.get_wait_time(watermark)
-                        current_log_time = time.time()
-                        # log a message when the wait_time changes OR if the log interval has passed
-                        if (wait_time != self.old_wait_time) or ((current_log_time - self.last_log_time) > self.log_interval_in_seconds):
-                            logging.info("senzing-{0}0005I Governor waiting {1} seconds for {2} database age(XID) to go from current value of {3} ({4}) to low watermark of {5}.".format(
-                                SENZING_PRODUCT_ID, wait_time, database_name, watermark, oid_name, self.low_watermark))
-                            self.old_wait_time = wait_time
-                            self.last_log_time = current_log_time
-                    elif self.old_wait_time != 0.0:
-                        logging.info("Governor delay ended. Returning to no wait.")
-                        self.old_wait_time = 0.0
+        futures = {}
+        for database_connection in self.database_connections.values():
+            futures[self.check_pool.submit(
+                self.check_database, database_connection)] = database_connection
+
+        # Bound the wait so an unresponsive database cannot hang the checker
+        # thread; databases that miss the deadline are skipped this round and
+        # logged, and the rest still refresh the wait time.
+
+        done, not_done = concurrent.futures.wait(
+            futures, timeout=self.check_time_interval_in_seconds)
+        for future in not_done:
+            database_connection = futures[future]
+            logging.warning("senzing-{0}0702W Governor check timed out, will retry. Host: {1}; Database: {2}".format(
+                SENZING_PRODUCT_ID, database_connection.host, database_connection.dbname))
+
+        worst_oid_name = None
+        worst_watermark = None
+        worst_database_name = None
+        for future in done:
+            database_connection = futures[future]
+            database_host = database_connection.host
+            database_name = database_connection.dbname
+            oid_name, watermark = future.result()
+
+            # only log a message when the log interval has passed
+            if ((now - self.last_log_time) > self.log_interval_in_seconds):
+                relation_size = self.get_relation_size(
+                    database_connection, oid_name)
+                logging.info("senzing-{0}0004I Governor is checking PostgreSQL Transaction IDs. Host: {1}; Database: {2}; Current XID: {3} ({4}, {5}); High watermark XID: {6}".format(
+                    SENZING_PRODUCT_ID, database_host, database_name, watermark, oid_name, relation_size, self.high_watermark))
+                self.last_log_time = now
+
+            if (worst_watermark is None) or (watermark > worst_watermark):
+                worst_oid_name = oid_name
+                worst_watermark = watermark
+                worst_database_name = database_name
+
+        # When the worst database gets above the low water mark, use our
+        # wait time function to start to slow down.
+
+        if (worst_watermark is not None) and (worst_watermark > self.low_watermark):
+            wait_time = self.get_wait_time(worst_watermark)
+            # log a message when the wait_time changes OR if the log interval has passed
+            if (wait_time != self.old_wait_time) or ((now - self.last_log_time) > self.log_interval_in_seconds):
+                logging.info("senzing-{0}0005I Governor waiting {1} seconds for {2} database age(XID) to go from current value of {3} ({4}) to low watermark of {5}.".format(
+                    SENZING_PRODUCT_ID, wait_time, worst_database_name, worst_watermark, worst_oid_name, self.low_watermark))
+                self.old_wait_time = wait_time
+                self.last_log_time = now
+        elif self.old_wait_time != 0.0:
+            logging.info("Governor delay ended. Returning to no wait.")
+            self.old_wait_time = 0.0
+
+        # Publish the result for the fast path.
+
+        self.wait_time_cache = self.old_wait_time
         return self.old_wait_time
 
     def close(self, *args, **kwargs):
         '''  Tasks to perform when shutting down, e.g., close DB connections '''
 
+        if self.checker_thread:
+            self.stop_event.set()
+            # bounded: the checker may be stuck on an unresponsive database
+            # and it is a daemon thread, so don't hang shutdown on it
+            self.checker_thread.join(self.check_time_interval_in_seconds)
+        if self.check_pool:
+            self.check_pool.shutdown(wait=False)
         for database_connection in self.database_connections.values():
-            database_connection.get('cursor').close()
-            database_connection.get('connection').close()
+            database_connection.pool.closeall()
         logging.info(
             "senzing-{0}0006I Governor closed.".format(SENZING_PRODUCT_ID))
 
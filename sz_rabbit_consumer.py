@@ -1,15 +1,19 @@
 #! /usr/bin/env python3
 
-import concurrent.futures
-
 import argparse
+import array
+import collections
+import functools
+import heapq
 import orjson
 import logging
 import traceback
 
 import importlib
+import queue
 import sys
 import os
+import threading
 import time
 import random
 import pika
@@ -17,46 +21,75 @@ import pika
 from senzing import G2Engine, G2Exception, G2EngineFlags, G2RetryTimeoutExceededException, G2BadInputException
 
 INTERVAL = 10000
-LONG_RECORD = 300
+LONG_RECORD = 300  # seconds
+LONG_RECORD_NS = LONG_RECORD * 1_000_000_000
 
-MSG_FRAME = 0
-MSG_BODY = 2
+log_format = "%(asctime)s %(message)s"
 
-TUPLE_MSG = 0
-TUPLE_STARTTIME = 1
-TUPLE_ACKED = 2
+log_level_map = {
+    "notset": logging.NOTSET,
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "fatal": logging.FATAL,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "critical": logging.CRITICAL,
+}
+
+# per-thread reusable response buffer for addRecordWithInfo
+_tls = threading.local()
+
+# Only DATA_SOURCE and RECORD_ID are needed from each record: msgspec
+# decodes just those two top-level fields into a slot-based struct and
+# skips everything else without allocating it; orjson builds the whole
+# dict and is only used if msgspec is missing.  A raw byte scan would be
+# faster still, but it can match a "DATA_SOURCE" key nested inside a
+# sub-object and silently load the record under the wrong ids.
+try:
+    import msgspec
 
-log_format = "%(asctime)s %(message)s"
+    class _Record(msgspec.Struct):
+        DATA_SOURCE: str
+        RECORD_ID: str
 
+    _record_decoder = msgspec.json.Decoder(_Record)
 
-def process_msg(engine, msg, info):
-    try:
+    def record_ids(msg):
+        """Extract (DATA_SOURCE, RECORD_ID) without materializing the whole record."""
+        record = _record_decoder.decode(msg)
+        return record.DATA_SOURCE, record.RECORD_ID
+
+except ImportError:
+
+    def record_ids(msg):
+        """Extract (DATA_SOURCE, RECORD_ID) from the record."""
         record = orjson.loads(msg)
+        return record["DATA_SOURCE"], record["RECORD_ID"]
+
+
+def process_msg(engine, msg, data_source, record_id, info):
+    try:
+        # the Senzing SDK accepts bytes for string arguments, so the body is
+        # handed over as-is; decoding to str would just copy the whole record
         if info:
-            response = bytearray()
-            engine.addRecordWithInfo(
-                record["DATA_SOURCE"], record["RECORD_ID"], msg.decode(), response
-            )
+            # reuse this worker's buffer between messages; note clearing a
+            # bytearray releases its capacity, so this only saves the object
+            # allocation, not the regrow
+            response = getattr(_tls, "response", None)
+            if response is None:
+                response = _tls.response = bytearray()
+            response.clear()
+            engine.addRecordWithInfo(data_source, record_id, msg, response)
             return response.decode()
         else:
-            engine.addRecord(record["DATA_SOURCE"], record["RECORD_ID"], msg.decode())
+            engine.addRecord(data_source, record_id, msg)
             return None
     except Exception as err:
         print(f"{err} [{msg}]", file=sys.stderr)
         raise
 
 
-try:
-    log_level_map = {
-        "notset": logging.NOTSET,
-        "debug": logging.DEBUG,
-        "info": logging.INFO,
-        "fatal": logging.FATAL,
-        "warning": logging.WARNING,
-        "error": logging.ERROR,
-        "critical": logging.CRITICAL,
-    }
-
+def main():
     log_level_parameter = os.getenv("SENZING_LOG_LEVEL", "info").lower()
     log_level = log_level_map.get(log_level_parameter, logging.INFO)
     logging.basicConfig(format=log_format, level=log_level)
@@ -106,178 +139,473 @@ try:
         args.url = os.getenv("SENZING_AMQP_URL")
 
     max_workers = int(os.getenv("SENZING_THREADS_PER_PROCESS", 0))
-    if not max_workers:  # reset to null for executors
-        max_workers = None
+    if not max_workers:  # same default ThreadPoolExecutor would have picked
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    # fork before the engine or any threads exist: each process is a full
+    # consumer with its own G2Engine and its own connection, and RabbitMQ
+    # round-robins the queue across them, so the Python-side share of the
+    # work scales past a single GIL
+    num_processes = int(os.getenv("SENZING_PROCESSES", 0))
+    for _ in range(num_processes - 1):
+        if os.fork() == 0:
+            break  # child falls through into its own consumer
 
     # Initialize the G2Engine
     g2 = G2Engine()
     g2.init("sz_rabbit_consumer", engine_config, args.debugTrace)
-    logCheckTime = prevTime = time.time()
 
     senzing_governor = importlib.import_module("senzing_governor")
     governor = senzing_governor.Governor(hint="sz_rabbit_consumer")
 
+    run_consumer(args, g2, governor, max_workers)
+
+
+def run_consumer(args, g2, governor, max_workers):
+    # the hot loop lives in a function so every name it touches is an
+    # array-indexed LOAD_FAST instead of a module-dict lookup
     params = pika.URLParameters(args.url)
     with pika.BlockingConnection(params) as conn:
         messages = 0
-        ch = conn.channel()
-        ch.queue_declare(queue=args.queue, passive=True)
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
-            print(f"Threads: {executor._max_workers}")
-            futures = {}
+        interval_left = INTERVAL  # countdown to the next rate-stats print
+        prevTime = time.monotonic_ns()
+        # a single AMQP channel serializes its frames; past ~32 workers open
+        # extra channels on the same connection, each with its own prefetch
+        # window, and route every settle back to the channel that delivered
+        # the message
+        n_channels = max(1, max_workers // 32)
+        channels = [conn.channel() for _ in range(n_channels)]
+        channels[0].queue_declare(queue=args.queue, passive=True)
+
+        print(f"Threads: {max_workers}")
+        max_slots = max_workers
+        # in-flight messages live in parallel arrays indexed by a small
+        # slot id: the watchdog scan walks contiguous memory and state
+        # changes are single element stores instead of tuple rebuilds
+        slot_start_times = array.array("q", [0] * max_slots)
+        slot_acked = bytearray(max_slots)
+        slot_tags = [0] * max_slots
+        slot_ids = [None] * max_slots
+        slot_chans = bytearray(max_slots)  # which channel delivered the slot
+        free_slots = list(range(max_slots))
+        # persistent worker threads pull (slot, body, ids) items off work_q
+        # and push (slot, result, exception) completions onto done_queue;
+        # both are C-implemented SimpleQueues, so there is no Future or
+        # work-item allocation per message and no condition-variable
+        # wake-all on every completion
+        work_q = queue.SimpleQueue()
+        done_queue = queue.SimpleQueue()
+        # completed delivery tags waiting to be acked; acks are batched
+        # with multiple=True once a contiguous prefix has finished.
+        # delivery tags count per channel, so each channel keeps its own
+        # heap and its own next-expected tag
+        ack_heaps = [[] for _ in channels]
+        next_confirm_tags = [1] * n_channels
+        # delivered-but-not-yet-dispatched messages; bounded in practice
+        # by the prefetch window
+        pending = collections.deque()
+        # (slot, delivery_tag) pairs the watcher wants rejected; pika
+        # channels are not thread safe so the main loop performs them
+        reject_requests = collections.deque()
+        watch_stop = threading.Event()
+
+        def make_on_msg(chan):
+            def on_msg(channel, method, properties, body):
+                # deliveries only land in the local buffer here; the main
+                # loop dispatches them when a worker is free and the
+                # governor allows it
+                pending.append((chan, method, properties, body))
+
+            return on_msg
+
+        def worker():
+            # per-thread bindings for the same LOAD_FAST reason as the
+            # dispatch loop's
+            get_work = work_q.get
+            put_done = done_queue.put
+            engine = g2
+            info = args.info
+            while True:
+                item = get_work()
+                if item is None:  # shutdown sentinel
+                    return
+                slot, body, data_source, record_id = item
+                try:
+                    result = process_msg(engine, body, data_source, record_id, info)
+                    put_done((slot, result, None))
+                except Exception as exc:
+                    put_done((slot, None, exc))
+
+        workers = [
+            threading.Thread(target=worker, name=f"engine-{n}", daemon=True)
+            for n in range(max_workers)
+        ]
+        for worker_thread in workers:
+            worker_thread.start()
+
+        def watcher():
+            # long-record scan on its own timer so the completion loop
+            # never burns time walking in-flight state; only reads the
+            # slot arrays (each read is a single atomic load) and hands
+            # rejects back to the main loop
+            while not watch_stop.wait(LONG_RECORD / 2):
+                response = bytearray()
+                g2.stats(response)
+                print(f"\n{response.decode()}\n")
+
+                nowTime = time.monotonic_ns()
+                numStuck = 0
+                numRejected = 0
+                for slot in range(max_slots):
+                    start_time = slot_start_times[slot]
+                    if not start_time:  # free slot
+                        continue
+                    duration = nowTime - start_time
+                    if (
+                        duration > 2 * LONG_RECORD_NS
+                    ):  # a record taking this long should be rejected to the dead letter queue
+                        numRejected += 1
+                        if not slot_acked[slot]:
+                            reject_requests.append((slot, slot_tags[slot]))
+                    if duration > LONG_RECORD_NS:
+                        numStuck += 1
+                        ids = slot_ids[slot]
+                        if ids:
+                            data_source, record_id = ids
+                            print(
+                                f'Still processing ({duration / 60e9:.3g} min, rejected: {bool(slot_acked[slot])}): {data_source} : {record_id}'
+                            )
+                if numStuck >= max_slots:
+                    print(
+                        f"All {max_slots} threads are stuck on long running records"
+                    )
+                #if numRejected >= max_slots:
+                #    print(f"Running recovery")
+                #    ch.basic_recover()  # supposedly this causes unacked messages to redeliver, should prevent the server from disconnecting us
+
+        threading.Thread(target=watcher, name="long-record-watcher", daemon=True).start()
+
+        io_stop = threading.Event()
+        io_error = []
+        io_thread = None
+
+        # bind the bound methods the loop calls per message once, so
+        # each call site is a plain LOAD_FAST instead of an attribute
+        # lookup at 10k+ msg/s; bound before the try so the shutdown
+        # handler can use them even when setup itself raises
+        add_callback = conn.add_callback_threadsafe
+        acks = [channel.basic_ack for channel in channels]
+        rejects = [channel.basic_reject for channel in channels]
+        partial = functools.partial
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        done_get = done_queue.get
+        done_get_nowait = done_queue.get_nowait
+        dispatch = work_q.put
+        pop_pending = pending.popleft
+        fast_check = governor.fast_check
+        extract_ids = record_ids
+        monotonic_ns = time.monotonic_ns
+
+        try:
+            # prefetch beyond the worker count so a completion never has
+            # to wait a broker round-trip for the next record; the extra
+            # messages sit in the pending buffer until a worker frees up
+            prefetch = int(
+                os.getenv("SENZING_PREFETCH", max(2 * max_workers, 50))
+            )
+            for chan, channel in enumerate(channels):
+                channel.basic_qos(prefetch_count=prefetch, global_qos=False)
+                channel.basic_consume(
+                    args.queue, on_message_callback=make_on_msg(chan), auto_ack=False
+                )  # the broker streams messages; no per-message round-trip
+
+            def amqp_io():
+                # sole driver of the connection from here on, so
+                # heartbeats and deliveries keep flowing no matter how
+                # busy the dispatch loop gets; every channel operation
+                # from other threads goes through add_callback_threadsafe
+                while not io_stop.is_set():
+                    try:
+                        conn.process_data_events(time_limit=0.5)
+                    except Exception as exc:
+                        if not io_stop.is_set():
+                            io_error.append(exc)
+                        break
+
+            io_thread = threading.Thread(
+                target=amqp_io, name="amqp-io", daemon=True
+            )
+            io_thread.start()
+
+            while True:
+                if io_error:  # the connection died on the I/O thread
+                    raise io_error[0]
+
+                if len(free_slots) == max_slots and not pending:
+                    # nothing in flight and nothing buffered; deliveries
+                    # arrive on the I/O thread so just idle briefly
+                    time.sleep(0.1)
+
+                nowTime = monotonic_ns()
+                if len(free_slots) < max_slots:
+                    # process completions straight off the queue: only block
+                    # for the first one when there is nothing waiting to
+                    # dispatch, then keep going until the queue is dry; a
+                    # completion that errors out stays settled in order and
+                    # anything not yet popped is still on the queue for the
+                    # shutdown path
+                    may_block = not (pending and free_slots)
+                    while True:
+                        try:
+                            if may_block:
+                                slot, result, exc = done_get(timeout=10)
+                                may_block = False
+                            else:
+                                slot, result, exc = done_get_nowait()
+                        except queue.Empty:
+                            break
+
+                        delivery_tag = slot_tags[slot]
+                        was_acked = slot_acked[slot]
+                        chan = slot_chans[slot]
+                        if exc is None:
+                            if result:
+                                print(
+                                    result
+                                )  # we would handle pushing to withinfo queues here BUT that is likely a second future task/executor
+                            # ack is deferred and batched below; a message
+                            # we rejected before should not be acked again
+                            heappush(
+                                ack_heaps[chan], (delivery_tag, not was_acked)
+                            )
+                        elif isinstance(
+                            exc, (G2RetryTimeoutExceededException, G2BadInputException)
+                        ):
+                            if not was_acked:  # if we rejected a message before we should not ack it here
+                              data_source, record_id = slot_ids[slot]
+                              print(
+                                  f'REJECTING due to bad data or timeout: {data_source} : {record_id}'
+                              )
+                              add_callback(
+                                  partial(
+                                      rejects[chan],
+                                      delivery_tag,
+                                      requeue=False,
+                                  )
+                              )
+                            # already settled; recorded only so the
+                            # contiguous prefix can keep advancing
+                            heappush(ack_heaps[chan], (delivery_tag, False))
+                        else:
+                            raise exc  # non-data error; shut down below
+
+                        # release the slot
+                        slot_start_times[slot] = 0
+                        slot_ids[slot] = None
+                        free_slots.append(slot)
+
+                        messages += 1
+                        interval_left -= 1
+
+                        if not interval_left:  # display rate stats
+                            interval_left = INTERVAL
+                            diff = nowTime - prevTime
+                            speed = -1
+                            if diff > 0:
+                                speed = int(INTERVAL * 1_000_000_000 / diff)
+                            print(
+                                f"Processed {messages} adds, {speed} records per second"
+                            )
+                            prevTime = nowTime
+
+                    # Ack the contiguous prefix of finished tags on each
+                    # channel with a single multi ack instead of one frame
+                    # per message.  Tags settled by an earlier reject just
+                    # advance the prefix.
+                    for chan in range(n_channels):
+                        ack_heap = ack_heaps[chan]
+                        next_confirm_tag = next_confirm_tags[chan]
+                        batch_ack_tag = 0
+                        while ack_heap and ack_heap[0][0] == next_confirm_tag:
+                            delivery_tag, needs_ack = heappop(ack_heap)
+                            next_confirm_tag += 1
+                            if needs_ack:
+                                batch_ack_tag = delivery_tag
+                        next_confirm_tags[chan] = next_confirm_tag
+                        if batch_ack_tag:
+                            add_callback(
+                                partial(
+                                    acks[chan], batch_ack_tag, multiple=True
+                                )
+                            )
+
+                        # a long-running record can block the prefix and pin
+                        # the prefetch window; once the backlog of finished
+                        # tags gets large, fall back to individual acks and
+                        # leave them in the heap as settled so the prefix
+                        # bookkeeping still advances when the gap closes
+                        if len(ack_heap) > prefetch // 2:
+                            for i, (delivery_tag, needs_ack) in enumerate(ack_heap):
+                                if needs_ack:
+                                    add_callback(
+                                        partial(acks[chan], delivery_tag)
+                                    )
+                                    ack_heap[i] = (delivery_tag, False)
+
+                # rejects requested by the watcher thread; re-validate
+                # everything against the arrays the main loop owns,
+                # including that the slot still looks stuck: the watcher's
+                # snapshot races with completion, and a slot that completed
+                # and was re-dispatched in between must not get its fresh
+                # record dead-lettered
+                while reject_requests:
+                    slot, delivery_tag = reject_requests.popleft()
+                    start_time = slot_start_times[slot]
+                    if (
+                        start_time
+                        and slot_tags[slot] == delivery_tag
+                        and not slot_acked[slot]
+                        and monotonic_ns() - start_time > 2 * LONG_RECORD_NS
+                    ):
+                        data_source, record_id = slot_ids[slot]
+                        print(f'REJECTING: {data_source} : {record_id}')
+                        add_callback(
+                            partial(
+                                rejects[slot_chans[slot]], delivery_tag, requeue=False
+                            )
+                        )
+                        slot_acked[slot] = 1
+
+                pauseSeconds = fast_check()
+                if pauseSeconds < 0.0:
+                    # governor fully triggered: hold buffered messages and
+                    # idle; the I/O thread keeps heartbeats and acks flowing
+                    time.sleep(1)
+                    continue
+                if pauseSeconds > 0.0:
+                    time.sleep(pauseSeconds)
+
+                # dispatch buffered messages while workers are free; the
+                # two ids are extracted once here and travel with the
+                # message so no later path re-parses the body
+                while pending and free_slots:
+                    chan, method, properties, body = pop_pending()
+                    data_source, record_id = extract_ids(body)
+                    slot = free_slots.pop()
+                    slot_tags[slot] = method.delivery_tag
+                    slot_chans[slot] = chan
+                    slot_acked[slot] = 0
+                    slot_ids[slot] = (data_source, record_id)
+                    slot_start_times[slot] = monotonic_ns()
+                    dispatch((slot, body, data_source, record_id))
+
+            print(f"Processed total of {messages} adds")
+
+        except Exception as err:
+            print(
+                f"{type(err).__name__}: Shutting down due to error: {err}",
+                file=sys.stderr,
+            )
+            traceback.print_exc()
+            watch_stop.set()
+            nowTime = time.monotonic_ns()
+
+            # let each worker finish the record it already started; the
+            # sentinels queue behind at most a slot's worth of dispatched
+            # work, so this is the same bounded wait shutdown always had
+            for _ in workers:
+                work_q.put(None)
+            for worker_thread in workers:
+                worker_thread.join()
+
+            # settle whatever finished with one batched ack so completed
+            # work isn't redelivered after we disconnect
             try:
-                ch.basic_qos(
-                    prefetch_count=executor._max_workers
-                )  # always have 1 record prefetched for each thread
                 while True:
-
-                    nowTime = time.time()
-                    if futures:
-                        done, _ = concurrent.futures.wait(
-                            futures,
-                            timeout=10,
-                            return_when=concurrent.futures.FIRST_COMPLETED,
+                    slot, result, exc = done_get_nowait()
+                    delivery_tag = slot_tags[slot]
+                    chan = slot_chans[slot]
+                    if exc is None:
+                        heappush(
+                            ack_heaps[chan], (delivery_tag, not slot_acked[slot])
                         )
-
-                        for fut in done:
-                            msg = futures.pop(fut)
+                    elif isinstance(
+                        exc, (G2RetryTimeoutExceededException, G2BadInputException)
+                    ):
+                        if not slot_acked[slot]:
                             try:
-                                result = fut.result()
-                                if result:
-                                    print(
-                                        result
-                                    )  # we would handle pushing to withinfo queues here BUT that is likely a second future task/executor
-                                if not msg[
-                                    TUPLE_ACKED
-                                ]:  # if we rejected a message before we should not ack it here
-                                    ch.basic_ack(msg[TUPLE_MSG][MSG_FRAME].delivery_tag)
-                            except (G2RetryTimeoutExceededException, G2BadInputException) as err:
-                                if not msg[
-                                    TUPLE_ACKED
-                                ]:  # if we rejected a message before we should not ack it here
-                                  record = orjson.loads(msg[TUPLE_MSG][MSG_BODY])
-                                  print(
-                                      f'REJECTING due to bad data or timeout: {record["DATA_SOURCE"]} : {record["RECORD_ID"]}'
-                                  )
-                                  ch.basic_reject(
-                                      msg[TUPLE_MSG][MSG_FRAME].delivery_tag,
-                                      requeue=False,
-                                  )
-
-                            messages += 1
-
-                            if messages % INTERVAL == 0:  # display rate stats
-                                diff = nowTime - prevTime
-                                speed = -1
-                                if diff > 0.0:
-                                    speed = int(INTERVAL / diff)
-                                print(
-                                    f"Processed {messages} adds, {speed} records per second"
-                                )
-                                prevTime = nowTime
-
-                        if nowTime > logCheckTime + (
-                            LONG_RECORD / 2
-                        ):  # log long running records
-                            logCheckTime = nowTime
-
-                            response = bytearray()
-                            g2.stats(response)
-                            print(f"\n{response.decode()}\n")
-
-                            numStuck = 0
-                            numRejected = 0
-                            for fut, msg in futures.items():
-                                if not fut.done():
-                                    duration = nowTime - msg[TUPLE_STARTTIME]
-                                    if (
-                                        duration > 2 * LONG_RECORD
-                                    ):  # a record taking this long should be rejected to the dead letter queue
-                                        numRejected += 1
-                                        if not msg[TUPLE_ACKED]:
-                                            record = orjson.loads(
-                                                msg[TUPLE_MSG][MSG_BODY]
-                                            )
-                                            print(
-                                                f'REJECTING: {record["DATA_SOURCE"]} : {record["RECORD_ID"]}'
-                                            )
-                                            ch.basic_reject(
-                                                msg[TUPLE_MSG][MSG_FRAME].delivery_tag,
-                                                requeue=False,
-                                            )
-                                            futures[fut] = (
-                                                msg[TUPLE_MSG],
-                                                msg[TUPLE_STARTTIME],
-                                                True,
-                                            )
-                                            msg = futures[fut]
-                                    if duration > LONG_RECORD:
-                                        numStuck += 1
-                                        record = orjson.loads(msg[TUPLE_MSG][MSG_BODY])
-                                        print(
-                                            f'Still processing ({duration/60:.3g} min, rejected: {msg[TUPLE_ACKED]}): {record["DATA_SOURCE"]} : {record["RECORD_ID"]}'
-                                        )
-                                if numStuck >= executor._max_workers:
-                                    print(
-                                        f"All {executor._max_workers} threads are stuck on long running records"
+                                add_callback(
+                                    partial(
+                                        rejects[chan], delivery_tag, requeue=False
                                     )
-                                #if numRejected >= executor._max_workers:
-                                #    print(f"Running recovery")
-                                #    ch.basic_recover()  # supposedly this causes unacked messages to redeliver, should prevent the server from disconnecting us
-
-                    if len(futures) >= executor._max_workers:
-                        conn.sleep(1)  # process rabbitmq protocol for 1s
-                        continue
-
-                    # Really want something that forces an "I'm alive" to the server
-                    pauseSeconds = governor.govern()
-                    # either governor fully triggered or our executor is full
-                    # not going to get more messages
-                    if pauseSeconds < 0.0:
-                        conn.sleep(1)  # process rabbitmq protocol for 1s
-                        continue
-                    if pauseSeconds > 0.0:
-                        conn.sleep(pauseSeconds)
-
-                    while len(futures) < executor._max_workers:
-                        try:
-                            msg = next(ch.consume(args.queue,inactivity_timeout=10))
-                            # print(msg)
-                            if not msg or not msg[MSG_FRAME]:
-                                if len(futures) == 0:
-                                    conn.sleep(0.1)
-                                break
-                            futures[
-                                executor.submit(
-                                    process_msg, g2, msg[MSG_BODY], args.info
                                 )
-                            ] = (msg, time.time(), False)
-                        except Exception as err:
-                            print(f"{type(err).__name__}: {err}", file=sys.stderr)
-                            raise
-
-                print(f"Processed total of {messages} adds")
-
-            except Exception as err:
+                            except Exception:
+                                # connection already dead (the usual reason
+                                # we're here); keep settling and reporting
+                                pass
+                        heappush(ack_heaps[chan], (delivery_tag, False))
+                    # anything else stays unsettled; the final nack below
+                    # requeues it
+                    slot_start_times[slot] = 0
+                    slot_ids[slot] = None
+                    free_slots.append(slot)
+            except queue.Empty:
+                pass
+            for slot, start_time in enumerate(slot_start_times):
+                if not start_time:
+                    continue
+                duration = nowTime - start_time
+                data_source, record_id = slot_ids[slot]
                 print(
-                    f"{type(err).__name__}: Shutting down due to error: {err}",
-                    file=sys.stderr,
+                    f'Still processing ({duration / 60e9:.3g} min, rejected: {bool(slot_acked[slot])}): {data_source} : {record_id}'
                 )
-                traceback.print_exc()
-                nowTime = time.time()
-                for fut, msg in futures.items():
-                    if not fut.done():
-                        duration = nowTime - msg[TUPLE_STARTTIME]
-                        record = orjson.loads(msg[TUPLE_MSG][MSG_BODY])
-                        print(
-                            f'Still processing ({duration/60:.3g} min, rejected: {msg[TUPLE_ACKED]}): {record["DATA_SOURCE"]} : {record["RECORD_ID"]}'
+            for chan in range(n_channels):
+                ack_heap = ack_heaps[chan]
+                next_confirm_tag = next_confirm_tags[chan]
+                batch_ack_tag = 0
+                while ack_heap and ack_heap[0][0] == next_confirm_tag:
+                    delivery_tag, needs_ack = heappop(ack_heap)
+                    next_confirm_tag += 1
+                    if needs_ack:
+                        batch_ack_tag = delivery_tag
+                next_confirm_tags[chan] = next_confirm_tag
+                if batch_ack_tag:
+                    try:
+                        add_callback(
+                            partial(acks[chan], batch_ack_tag, multiple=True)
+                        )
+                    except Exception:
+                        pass  # connection already dead; broker requeues on disconnect
+
+            # requeue everything unsettled in one nack per channel instead
+            # of waiting for the connection timeout
+            try:
+                for channel in channels:
+                    add_callback(
+                        partial(
+                            channel.basic_nack, delivery_tag=0, multiple=True, requeue=True
                         )
-                executor.shutdown()
-                conn.close()
-                exit(-1)
-
-except Exception as err:
-    print(err, file=sys.stderr)
-    traceback.print_exc()
-    exit(-1)
+                    )
+            except Exception:
+                pass  # channel may already be dead; broker requeues on disconnect
+            io_stop.set()
+            if io_thread is not None:
+                io_thread.join()
+            try:
+                # sole owner of the connection again; run any callbacks
+                # the I/O thread didn't get to before stopping
+                conn.process_data_events(time_limit=0)
+            except Exception:
+                pass
+            conn.close()
+            exit(-1)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        print(err, file=sys.stderr)
+        traceback.print_exc()
+        exit(-1)
@@ -15,6 +15,10 @@ from werkzeug.utils import secure_filename
 
 INTERVAL = 1000
 
+# flush the accumulated bodies and ack the batch once either limit is hit
+FLUSH_BYTES = 1 << 20
+FLUSH_MSGS = 500
+
 MSG_FRAME = 0
 MSG_BODY = 2
 
@@ -60,8 +64,14 @@ try:
 
     params = pika.URLParameters(args.url)
     with pika.BlockingConnection(params) as conn:
-        with open(secure_filename(args.output), "a") as fpOut:
+        # binary and unbuffered: the body is already UTF-8 JSON bytes, so
+        # writing it as-is skips the text-mode decode/re-encode round-trip
+        # and each flush below is a single write
+        with open(secure_filename(args.output), "ab", buffering=0) as fpOut:
             messages = 0
+            buf = bytearray()
+            buf_msgs = 0
+            last_tag = 0
             ch = conn.channel()
             ch.queue_declare(queue=args.queue, passive=True)
             for msg in ch.consume(args.queue, inactivity_timeout=1):
@@ -69,11 +79,19 @@ try:
                     break
                 try:
                     nowTime = time.time()
-                    fpOut.write(msg[MSG_BODY].decode())
-                    fpOut.write('\n')
-                    ch.basic_ack(msg[MSG_FRAME].delivery_tag)
+                    buf += msg[MSG_BODY]
+                    buf += b'\n'
+                    buf_msgs += 1
+                    last_tag = msg[MSG_FRAME].delivery_tag
                     messages += 1
 
+                    if len(buf) >= FLUSH_BYTES or buf_msgs >= FLUSH_MSGS:
+                        fpOut.write(buf)
+                        # one multi-ack settles the whole batch
+                        ch.basic_ack(last_tag, multiple=True)
+                        buf.clear()
+                        buf_msgs = 0
+
                     if messages % INTERVAL == 0:  # display rate stats
                         diff = nowTime - prevTime
                         speed = -1
@@ -89,6 +107,10 @@ try:
                     conn.close()
                     exit(-1)
 
+            if buf:  # flush and settle the final partial batch
+                fpOut.write(buf)
+                ch.basic_ack(last_tag, multiple=True)
+
             print(f"Downloaded total of {messages} messages")
 
 